@@ -11,9 +11,9 @@ def train_ConvLSTM_Moving_MNIST():
     train_set = MovingMNISTDataset("train")
     test_set = MovingMNISTDataset("test")
     validation_set = MovingMNISTDataset("validation")
-    train_loader = DataLoader(train_set, batch_size=8, shuffle=True)
-    test_loader = DataLoader(test_set, batch_size=8)
-    validation_loader = DataLoader(validation_set, batch_size=8)
+    train_loader = DataLoader(train_set, batch_size=8, shuffle=True, num_workers=4, pin_memory=True)
+    test_loader = DataLoader(test_set, batch_size=8, num_workers=4, pin_memory=True)
+    validation_loader = DataLoader(validation_set, batch_size=8, num_workers=4, pin_memory=True)
     trainer = Trainer(max_epoch=1000, device="cuda:0", to_save="results/MovingMNIST/ConvLSTM")
     # trainer.fit(convlstm, train_loader, validation_loader)
 
@@ -2,8 +2,10 @@ import abc
 from typing import List, Tuple, Optional
 
 import torch
+import torch.nn.functional as F
 from torch import nn, Tensor
 from torch.optim import Optimizer
+from torch.utils.checkpoint import checkpoint
 
 from utils import reshape_patch, reshape_patch_back
 from utils.types import STEP_OUTPUT
@@ -18,7 +20,7 @@ __all__ = [
 
 class ConvLSTM(EnhancedModule, metaclass=abc.ABCMeta):
     def __init__(self, in_channels: int = 1, hidden_channels_list=None, size: Tuple[int, int] = (64, 64),
-                 kernel_size_list=None, forget_bias: float = 0.01):
+                 kernel_size_list=None, forget_bias: float = 0.01, use_checkpoint: bool = False):
         super().__init__()
         if hidden_channels_list is None:
             hidden_channels_list = [96, 96]
@@ -26,19 +28,26 @@ class ConvLSTM(EnhancedModule, metaclass=abc.ABCMeta):
             kernel_size_list = [3, 3]
 
         self.encoder = Encoder(in_channels=in_channels, hidden_channels_list=hidden_channels_list, size=size,
-                               kernel_size_list=kernel_size_list, forget_bias=forget_bias)
+                               kernel_size_list=kernel_size_list, forget_bias=forget_bias,
+                               use_checkpoint=use_checkpoint)
 
         self.forecast = Forecast(in_channels=in_channels, hidden_channels_list=hidden_channels_list, size=size,
-                                 kernel_size_list=kernel_size_list, forget_bias=forget_bias)
+                                 kernel_size_list=kernel_size_list, forget_bias=forget_bias,
+                                 use_checkpoint=use_checkpoint)
+
+        # 卷积全部走 NHWC，cuDNN 的 Tensor Core 卷积只在 channels_last 下启用
+        self.to(memory_format=torch.channels_last)
 
     # just for test
     def forward(self, inputs: Tensor, out_len: int = 10) -> Tensor:
-        states = self.encoder(inputs)
-        prediction = self.forecast(*states, out_len=out_len)
+        h, c = self.encoder(inputs)
+        prediction = self.forecast(h, c, out_len=out_len)
         return prediction
 
 
 class ConvLSTM_MovingMNIST(ConvLSTM):
+    # 只在训练时使用，torch.jit.script 时跳过
+    __jit_unused_properties__ = ["criterion"]
 
     @property
     def criterion(self):
@@ -48,11 +57,11 @@ class ConvLSTM_MovingMNIST(ConvLSTM):
         optimizer = torch.optim.Adam(self.parameters(), lr=1e-3)
         return optimizer
 
+    # 训练和验证时不做 clamp，clamp 会把 [0, 1] 以外的梯度置零，只在 predict_step 中截断输出
     def training_step(self, inputs, labels) -> STEP_OUTPUT:
         patched_inputs = reshape_patch(inputs, patch_size=4)
         patched_outputs = self.forward(patched_inputs, out_len=10)
         outputs = reshape_patch_back(patched_outputs, patch_size=4)
-        outputs = torch.clamp(outputs, 0, 1)
         loss = self.criterion(outputs, labels)
         return loss
 
@@ -60,103 +69,222 @@ class ConvLSTM_MovingMNIST(ConvLSTM):
         patched_inputs = reshape_patch(inputs, patch_size=4)
         patched_outputs = self.forward(patched_inputs, out_len=10)
         outputs = reshape_patch_back(patched_outputs, patch_size=4)
-        outputs = torch.clamp(outputs, 0, 1)
         loss = self.criterion(outputs, labels)
         return loss
 
-    def predict_step(self, inputs, labels) -> Tensor:
+    # 导出给 torch.jit.script，Trainer.predict 可以直接调用脚本化模型的 predict_step
+    @torch.jit.export
+    def predict_step(self, inputs: Tensor, labels: Tensor) -> Tensor:
         patched_inputs = reshape_patch(inputs, patch_size=4)
         patched_outputs = self.forward(patched_inputs, out_len=10)
         outputs = reshape_patch_back(patched_outputs, patch_size=4)
-        outputs = torch.clamp(outputs, 0, 1)
-        return outputs
+        # outputs 是 reshape_patch_back 新生成的张量，可以原地截断
+        return outputs.clamp_(0, 1)
 
 
-class Encoder(nn.Module):
+def can_fuse_hidden_conv(hidden_channels_list: List[int], kernel_size_list: List[int]) -> bool:
+    r"""
+    各层隐藏通道数和卷积核尺寸都相同时，所有层的 conv_h 才能合并成一次分组卷积
+    """
+    layers = len(hidden_channels_list)
+    return layers > 1 and len(set(hidden_channels_list)) == 1 and len(set(kernel_size_list[:layers])) == 1
+
+
+def fused_hidden_conv(h_stacked: Tensor, weight: Tensor, bias: Tensor, padding: int, layers: int) -> List[Tensor]:
+    r"""
+    同一时刻各层的 h 都只依赖上一时刻，彼此独立，所以各层的 conv_h 可以用一次 groups=layers 的分组卷积完成
+
+    :param h_stacked:  每一层上一时刻的隐藏状态沿通道拼接的结果，shape 为 (B, layers * hidden_channels, H, W)
+    :param weight:     各层 conv_h 权重沿输出通道拼接的结果
+    :param bias:       各层 conv_h 偏置拼接的结果
+    :param padding:    卷积的 padding
+    :param layers:     堆叠的层数
+    :return:           每一层的 conv_h(h)
+    """
+    h_concat = F.conv2d(h_stacked, weight, bias, padding=padding, groups=layers)
+    return list(torch.chunk(h_concat, layers, dim=1))
+
+
+class ConvLSTMCellStack(nn.ModuleList):
+    r"""
+    Encoder 和 Forecast 共用的堆叠 ConvLSTMCell，单步前进的逻辑只在这里实现一次。
+    TorchScript 不能把 Module 作为参数传给普通函数，所以这些辅助方法定义在 ModuleList 的子类上，
+    state_dict 的键和直接使用 ModuleList 时相同
+    """
 
     def __init__(self, in_channels: int, hidden_channels_list: List[int], size: Tuple[int, int],
                  kernel_size_list: List[int], forget_bias: float = 0.01):
+        r"""
+        参数见 Encoder
+        """
+        super(ConvLSTMCellStack, self).__init__()
+
+        self.layers = len(hidden_channels_list)
+        self.fuse_hidden_conv = can_fuse_hidden_conv(hidden_channels_list, kernel_size_list)
+        self.padding = kernel_size_list[0] // 2
+
+        for i in range(self.layers):
+            input_channels = in_channels if i == 0 else hidden_channels_list[i - 1]
+            self.append(
+                ConvLSTMCell(in_channels=input_channels, hidden_channels=hidden_channels_list[i], size=size,
+                             kernel_size=kernel_size_list[i], forget_bias=forget_bias)
+            )
+
+    def hidden_params(self) -> Optional[Tuple[Tensor, Tensor]]:
+        r"""
+        :return: 可以合并时，返回各层 conv_h 拼接后的权重和偏置，否则返回 None
+        """
+        if not self.fuse_hidden_conv:
+            return None
+
+        weights: List[Tensor] = []
+        biases: List[Tensor] = []
+        for cell in self:
+            bias = cell.conv_h.bias
+            assert bias is not None
+            weights.append(cell.conv_h.weight)
+            biases.append(bias)
+
+        return torch.cat(weights, dim=0), torch.cat(biases, dim=0)
+
+    def step(self, x: Tensor, h: List[Tensor], c: List[Tensor],
+             hidden_params: Optional[Tuple[Tensor, Tensor]] = None,
+             h_stacked: Optional[Tensor] = None,
+             scripted_gates: bool = True) -> Tuple[List[Tensor], List[Tensor]]:
+        r"""
+        所有堆叠层前进一个时间步
+
+        :param x:                当前时刻的输入，shape 为 (B, C, H, W)
+        :param h:                每一层上一时刻的隐藏状态
+        :param c:                每一层上一时刻的 cell
+        :param hidden_params:    hidden_params 的结果，不为 None 时各层的 conv_h 合并成一次分组卷积
+        :param h_stacked:        h 沿通道拼接的结果，调用方已经拼接过时传入，避免重复拼接
+        :param scripted_gates:   是否使用 TorchScript 融合的门控运算，见 ConvLSTMCell.forward_gates
+        :return:                 每一层当前时刻的 h 和 c
+        """
+        h_concat: List[Tensor] = []
+        if hidden_params is not None:
+            if h_stacked is None:
+                stacked = torch.cat(h, dim=1)
+            else:
+                stacked = h_stacked
+            h_concat = fused_hidden_conv(stacked, hidden_params[0], hidden_params[1], self.padding, self.layers)
+        else:
+            for i, cell in enumerate(self):
+                h_concat.append(cell.conv_h(h[i]))
+
+        next_h: List[Tensor] = []
+        next_c: List[Tensor] = []
+        for i, cell in enumerate(self):
+            x, cc = cell.forward_gates(x, h_concat[i], c[i], scripted_gates)
+            next_h.append(x)
+            next_c.append(cc)
+
+        return next_h, next_c
+
+    @torch.jit.unused
+    def checkpoint_step(self, x: Tensor, h: List[Tensor], c: List[Tensor],
+                        hidden_params: Optional[Tuple[Tensor, Tensor]] = None,
+                        h_stacked: Optional[Tensor] = None) -> Tuple[List[Tensor], List[Tensor]]:
+        r"""
+        同 step，但只保存输入，该时间步内的激活值在反向传播时重新计算。
+        TorchScript 解释器既传不出 checkpoint 提前结束重新计算的异常，两次运行保存的张量顺序也可能不同，
+        所以门控运算走 eager 版本
+        """
+        return checkpoint(self.step, x, h, c, hidden_params, h_stacked, False, use_reentrant=False)
+
+
+class Encoder(nn.Module):
+
+    def __init__(self, in_channels: int, hidden_channels_list: List[int], size: Tuple[int, int],
+                 kernel_size_list: List[int], forget_bias: float = 0.01, use_checkpoint: bool = False):
         """
         :param in_channels:                输入的通道数
         :param hidden_channels_list:       每一层隐藏层的通道数
         :param size:                       输入的尺寸, (Height, Width)
         :param kernel_size_list:           每一层卷积核尺寸
         :param forget_bias:                偏移量
+        :param use_checkpoint:             训练时每个时间步只保存输入，反向传播时重新计算激活值，以计算换显存
         """
         super(Encoder, self).__init__()
 
+        self.use_checkpoint = use_checkpoint
+
         self.hidden_channels_list = hidden_channels_list
         self.layers = len(hidden_channels_list)
+        self.uniform_hidden = len(set(hidden_channels_list)) == 1
 
         # 根据堆叠层数，构造ConvLSTMCell列表，加入到模型中
-        cell_list = nn.ModuleList([])
-        for i in range(self.layers):
-            input_channels = in_channels if i == 0 else hidden_channels_list[i - 1]
-            cell_list.append(
-                ConvLSTMCell(in_channels=input_channels, hidden_channels=hidden_channels_list[i], size=size,
-                             kernel_size=kernel_size_list[i], forget_bias=forget_bias)
-            )
-
-            self.encoder = cell_list
+        self.encoder = ConvLSTMCellStack(in_channels=in_channels, hidden_channels_list=hidden_channels_list,
+                                         size=size, kernel_size_list=kernel_size_list, forget_bias=forget_bias)
 
     def forward(self, inputs: Tensor) -> Tuple[List[Tensor], List[Tensor]]:
         """
         :param inputs: 输入的一个batch的时序数据，shape 为 (B, S, C, H, W)
         :return: 编码阶段之后的 h 和 c
         """
-        device = inputs.device
-
         batch, sequence, channel, height, width = inputs.shape
 
-        # 定义空列表，用于存储每个堆叠层的隐藏状态
-        h = []
-        c = []
-        # 初始化最开始的隐藏状态
-        for i in range(self.layers):
-            zero_tensor_h = torch.zeros(batch, self.hidden_channels_list[i], height, width).to(device)
-            zero_tensor_c = torch.zeros(batch, self.hidden_channels_list[i], height, width).to(device)
-            h.append(zero_tensor_h)
-            c.append(zero_tensor_c)
+        # 初始化最开始的隐藏状态，各层通道数相同时所有的 h 和 c 只分配一次，再沿 batch 维切分
+        if self.uniform_hidden:
+            zero_tensor = torch.empty(2 * self.layers * batch, self.hidden_channels_list[0], height, width,
+                                      device=inputs.device, dtype=inputs.dtype,
+                                      memory_format=torch.channels_last).zero_()
+            states = list(torch.chunk(zero_tensor, 2 * self.layers, dim=0))
+            h = states[:self.layers]
+            c = states[self.layers:]
+        else:
+            h = [torch.empty(batch, channels, height, width, device=inputs.device, dtype=inputs.dtype,
+                             memory_format=torch.channels_last).zero_() for channels in self.hidden_channels_list]
+            c = [torch.empty(batch, channels, height, width, device=inputs.device, dtype=inputs.dtype,
+                             memory_format=torch.channels_last).zero_() for channels in self.hidden_channels_list]
 
-        # 沿着时间维度循环
-        for s in range(sequence):
-            x = inputs[:, s]
+        # 在循环外一次性转成时间优先的 (S, B, C, H, W)，每一帧都是 NHWC 排布，inputs[s] 就是连续的 channels_last 张量
+        inputs = inputs.permute(1, 0, 3, 4, 2).contiguous().permute(0, 1, 4, 2, 3)
 
-            h[0], c[0] = self.encoder[0](x, h[0], c[0])
+        # 分组卷积的权重每次 forward 只拼接一次
+        hidden_params = self.encoder.hidden_params()
 
-            for i in range(1, self.layers):
-                h[i], c[i] = self.encoder[i](h[i - 1], h[i], c[i])
+        checkpoint_steps = self.use_checkpoint and self.training and torch.is_grad_enabled()
+
+        # 沿着时间维度循环
+        for s in range(sequence):
+            if checkpoint_steps and not torch.jit.is_scripting():
+                h, c = self.encoder.checkpoint_step(inputs[s], h, c, hidden_params)
+            else:
+                h, c = self.encoder.step(inputs[s], h, c, hidden_params)
 
         return h, c
 
 
 class Forecast(nn.Module):
     def __init__(self, in_channels: int, hidden_channels_list: List[int], size: Tuple[int, int],
-                 kernel_size_list: List[int], forget_bias: float = 0.01):
+                 kernel_size_list: List[int], forget_bias: float = 0.01, use_checkpoint: bool = False):
         r"""
         :param in_channels:              输入通道数
         :param hidden_channels_list:     隐藏层通道数列表
         :param size:                     输入的尺寸, (Height, Width)
         :param kernel_size_list:         卷积核列名
         :param forget_bias:              偏移量
+        :param use_checkpoint:           见 Encoder
         """
         super(Forecast, self).__init__()
 
+        self.use_checkpoint = use_checkpoint
+
         self.in_channels = in_channels
         self.hidden_channels_list = hidden_channels_list
         self.layers = len(hidden_channels_list)
         self.forget_bias = forget_bias
 
-        # 定义列秒存储堆叠的ConvLSTMCell
-        cell_list = nn.ModuleList([])
-        for i in range(self.layers):
-            input_channels = in_channels if i == 0 else hidden_channels_list[i - 1]
-            cell_list.append(
-                ConvLSTMCell(in_channels=input_channels, hidden_channels=hidden_channels_list[i], size=size,
-                             kernel_size=kernel_size_list[i], forget_bias=forget_bias)
-            )
+        # 每一层的 h 在拼接结果中的通道起止位置
+        self.channel_offsets = [0]
+        for hidden_channels in hidden_channels_list:
+            self.channel_offsets.append(self.channel_offsets[-1] + hidden_channels)
 
-        self.forecast = cell_list
+        # 定义列秒存储堆叠的ConvLSTMCell
+        self.forecast = ConvLSTMCellStack(in_channels=in_channels, hidden_channels_list=hidden_channels_list,
+                                          size=size, kernel_size_list=kernel_size_list, forget_bias=forget_bias)
 
         # 最终输出的通道数要和输入的通道数相同
         self.conv_last = nn.Conv2d(in_channels=sum(hidden_channels_list), out_channels=in_channels,
@@ -171,22 +299,51 @@ class Forecast(nn.Module):
         """
         batch, _, height, width = h[0].shape
 
-        prediction = []
-
-        for _ in range(out_len):
-            x = torch.zeros(batch, self.in_channels, height, width).to(h[0].device)
-
-            h[0], c[0] = self.forecast[0](x, h[0], c[0])
-
-            for i in range(1, self.layers):
-                h[i], c[i] = self.forecast[i](h[i - 1], h[i], c[i])
-
-            h_concat = torch.cat(h, dim=1)
-
-            pred = self.conv_last(h_concat)
-
-            prediction.append(pred)
-
-        prediction = torch.stack(prediction, dim=0).permute(1, 0, 2, 3, 4)
+        device, dtype = h[0].device, h[0].dtype
+
+        # conv_last 是不带偏置的 1x1 卷积，逐时刻调用等价于把所有时刻的 h 拼接结果沿 batch 维堆叠后只调用一次，
+        # 堆叠按时间优先，第 t 时刻占第 t * batch 到 (t + 1) * batch 行
+        h_concat_list: List[Tensor] = []
+        # 不需要求导时，每一步的 h 直接拷贝进预分配显存中对应时刻、对应层的切片，NHWC 下每个切片的拷贝都是连续的；
+        # 求导时后一时刻的写入会改变前面切片被保存的版本号，只能各自拼接后在循环结束时合并
+        h_concat_all: Optional[Tensor] = None
+        if not torch.is_grad_enabled():
+            h_concat_all = torch.empty(out_len * batch, self.channel_offsets[-1], height, width, device=device,
+                                       dtype=dtype, memory_format=torch.channels_last)
+
+        # 预测阶段没有外部输入，每一步都复用同一个全零张量，ConvLSTMCell 不会原地修改它
+        x = torch.empty(batch, self.in_channels, height, width, device=device, dtype=dtype,
+                        memory_format=torch.channels_last).zero_()
+
+        # 分组卷积的权重每次 forward 只拼接一次
+        hidden_params = self.forecast.hidden_params()
+
+        # h 沿通道拼接的结果同时是 conv_last 和下一时刻分组卷积的输入，只拼接一次
+        h_concat: Optional[Tensor] = None
+
+        checkpoint_steps = self.use_checkpoint and self.training and torch.is_grad_enabled()
+
+        for t in range(out_len):
+            if checkpoint_steps and not torch.jit.is_scripting():
+                h, c = self.forecast.checkpoint_step(x, h, c, hidden_params, h_concat)
+            else:
+                h, c = self.forecast.step(x, h, c, hidden_params, h_concat)
+
+            if h_concat_all is None:
+                step_concat = torch.cat(h, dim=1)
+                h_concat_list.append(step_concat)
+            else:
+                step_concat = h_concat_all[t * batch:(t + 1) * batch]
+                for i in range(self.layers):
+                    step_concat[:, self.channel_offsets[i]:self.channel_offsets[i + 1]].copy_(h[i])
+            h_concat = step_concat
+
+        if h_concat_all is None:
+            h_concat_stack = torch.cat(h_concat_list, dim=0)
+        else:
+            h_concat_stack = h_concat_all
+
+        prediction = self.conv_last(h_concat_stack)
+        prediction = prediction.view(out_len, batch, self.in_channels, height, width).transpose(0, 1)
 
         return prediction
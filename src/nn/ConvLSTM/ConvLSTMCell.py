@@ -6,6 +6,36 @@ from torch import nn, Tensor
 __all__ = ["ConvLSTMCell"]
 
 
+def lstm_gates(x_concat: Tensor, h_concat: Tensor, c: Tensor, w_ci: Tensor, w_co: Tensor,
+               forget_bias: float, hidden_channels: int) -> Tuple[Tensor, Tensor]:
+    r"""
+    ConvLSTM 的门控逐元素运算，卷积留在外面交给 cuDNN，这里的 sigmoid/tanh/mul/add 由 TorchScript 融合
+
+    :param x_concat:          conv_x 的输出，shape 为 (B, 4 * hidden_channels, H, W)
+    :param h_concat:          conv_h 的输出，shape 为 (B, 4 * hidden_channels, H, W)
+    :param c:                 上一时刻的 cell
+    :param w_ci:              输入门的 peephole 权重
+    :param w_co:              输出门的 peephole 权重
+    :param forget_bias:       偏置
+    :param hidden_channels:   隐藏层通道数
+    :return:                  更新过的 h 和 c
+    """
+    i_x, f_x, c_x, o_x = torch.split(x_concat, hidden_channels, dim=1)
+    i_h, f_h, c_h, o_h = torch.split(h_concat, hidden_channels, dim=1)
+
+    i = torch.sigmoid(i_x + i_h + w_ci * c)
+    f = torch.sigmoid(f_x + f_h + forget_bias)
+    c = f * c + i * torch.tanh(c_x + c_h)
+    o = torch.sigmoid(o_x + o_h + w_co * c)
+    h = o * torch.tanh(c)
+
+    return h, c
+
+
+# 融合版本，torch.utils.checkpoint 重新计算时不能经过 TorchScript 解释器，那时使用上面的 eager 版本
+scripted_lstm_gates = torch.jit.script(lstm_gates)
+
+
 class ConvLSTMCell(nn.Module):
     def __init__(self, in_channels: int, hidden_channels: int, size: Tuple[int, int],
                  kernel_size: int = 3, forget_bias: float = 0.01):
@@ -44,15 +74,20 @@ class ConvLSTMCell(nn.Module):
         if x is None and (h is None or c is None):
             raise ValueError("x 和 [h, c] 不能同时为 None")
 
-        x_concat = self.conv_x(x)
-        h_concat = self.conv_h(h)
-        i_x, f_x, c_x, o_x = torch.split(x_concat, self.hidden_channels, dim=1)
-        i_h, f_h, c_h, o_h = torch.split(h_concat, self.hidden_channels, dim=1)
+        return self.forward_gates(x, self.conv_h(h), c)
 
-        i = torch.sigmoid(i_x + i_h + self.w_ci * c)
-        f = torch.sigmoid(f_x + f_h + self.forget_bias)
-        c = f * c + i * torch.tanh(c_x + c_h)
-        o = torch.sigmoid(o_x + o_h + self.w_co * c)
-        h = o * torch.tanh(c)
+    def forward_gates(self, x: Tensor, h_concat: Tensor, c: Tensor,
+                      scripted_gates: bool = True) -> Tuple[Tensor, Tensor]:
+        """
+        :param x:                x 是输入的一个 batch 的某一时序，shape应该是 (B, in_channels, H, W)
+        :param h_concat:         conv_h(h) 的结果，堆叠多层时可以在外面合并成一次分组卷积
+        :param c:                c 是 cell 记忆的载体，shape应该是 (B, hidden_channels, H, W)
+        :param scripted_gates:   是否使用 TorchScript 融合的门控运算，checkpoint 时必须为 False
+        :return:                 更新过的 h 和 c
+        """
+        x_concat = self.conv_x(x)
 
-        return h, c
+        if scripted_gates:
+            return scripted_lstm_gates(x_concat, h_concat, c, self.w_ci, self.w_co, self.forget_bias,
+                                       self.hidden_channels)
+        return lstm_gates(x_concat, h_concat, c, self.w_ci, self.w_co, self.forget_bias, self.hidden_channels)
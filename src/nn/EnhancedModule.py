@@ -22,6 +22,8 @@ class EnhancedModule(nn.Module, metaclass=abc.ABCMeta):
         super(EnhancedModule, self).__init__()
         self.optimizer = None
         self.lr_scheduler = None
+        # set by Trainer.fit, a GradScaler that is only enabled under float16 autocast
+        self.scaler = None
 
     @abstractmethod
     def configure_optimizer(self) -> Optimizer: ...
@@ -99,7 +101,12 @@ class EnhancedModule(nn.Module, metaclass=abc.ABCMeta):
         """
 
     def optimizer_step(self):
-        self.optimizer.step()
+        if self.scaler is not None and self.scaler.is_enabled():
+            # the gradients are scaled under float16, GradScaler unscales them and skips the step on overflow
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
 
     def lr_scheduler_step(self):
         if self.lr_scheduler is not None:
@@ -4,30 +4,40 @@
 # @author: 芜情
 # @description: the trick for limit GPU memery
 
+import torch.nn.functional as F
 from torch import Tensor
 
 __all__ = ["reshape_patch", 'reshape_patch_back']
 
 
 def reshape_patch(img_tensor: Tensor, patch_size: int) -> Tensor:
+    r"""
+    :param img_tensor: shape is (B, S, C, H, W)
+    :param patch_size: the side length of each patch
+    :return: shape is (B, S, p * p * C, H / p, W / p), pixel (i, j) of channel c is at (i * p + j) * C + c
+    """
     if patch_size == 1:
         return img_tensor
 
-    assert 5 == img_tensor.ndim
+    assert 5 == img_tensor.dim()
     batch, seq, channel, height, width = img_tensor.shape
 
-    if height % patch_size or width % patch_size:
+    if height % patch_size != 0 or width % patch_size != 0:
         raise ValueError("\npatch must divide origin tensor to integers.\n")
 
+    patch_height = height // patch_size
+    patch_width = width // patch_size
+
+    # a single copy (at the reshape of d) that already leaves every frame in channels_last layout
     a = img_tensor.permute(0, 1, 3, 4, 2)
     b = a.reshape(batch, seq,
-                  height // patch_size, patch_size,
-                  width // patch_size, patch_size,
+                  patch_height, patch_size,
+                  patch_width, patch_size,
                   channel)
     c = b.permute(0, 1, 2, 4, 3, 5, 6)
     d = c.reshape(batch, seq,
-                  height // patch_size,
-                  width // patch_size,
+                  patch_height,
+                  patch_width,
                   patch_size * patch_size * channel)
     patch_tensor = d.permute(0, 1, 4, 2, 3)
 
@@ -35,24 +45,21 @@ def reshape_patch(img_tensor: Tensor, patch_size: int) -> Tensor:
 
 
 def reshape_patch_back(patch_tensor: Tensor, patch_size: int) -> Tensor:
+    r"""
+    the inverse of reshape_patch
+    """
     if patch_size == 1:
         return patch_tensor
 
-    assert 5 == patch_tensor.ndim
+    assert 5 == patch_tensor.dim()
     batch, seq, channel, height, width = patch_tensor.shape
-    a = patch_tensor.permute(0, 1, 3, 4, 2)
     img_channel = channel // (patch_size * patch_size)
 
-    b = a.reshape(batch, seq,
-                  height, width,
-                  patch_size, patch_size,
-                  img_channel)
-    c = b.permute(0, 1, 2, 4, 3, 5, 6)
-    d = c.reshape(batch, seq,
-                  height * patch_size,
-                  width * patch_size,
-                  img_channel)
-
-    img_tensor = d.permute(0, 1, 4, 2, 3)
+    a = patch_tensor.reshape(batch * seq, channel, height, width)
+    if img_channel > 1:
+        a = a.reshape(batch * seq, patch_size * patch_size, img_channel, height, width).transpose(1, 2)
+        a = a.reshape(batch * seq, channel, height, width)
+    b = F.pixel_shuffle(a, patch_size)
+    img_tensor = b.reshape(batch, seq, img_channel, height * patch_size, width * patch_size)
 
     return img_tensor
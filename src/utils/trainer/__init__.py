@@ -3,10 +3,14 @@
 # @time: 2022/4/8 10:16
 # @author: 芜情
 # @description:
+from .cuda_graph import GraphedPredictStep
 from .module_helpers import is_overridden
+from .prefetcher import DataPrefetcher
 from .trainer import Trainer
 
 __all__ = [
     "Trainer",
+    "DataPrefetcher",
+    "GraphedPredictStep",
     "is_overridden",
 ]
@@ -0,0 +1,67 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @description: replay the predict_step of a model with a CUDA graph
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+from nn import EnhancedModule
+
+__all__ = ["GraphedPredictStep"]
+
+
+class GraphedPredictStep(object):
+    r"""
+    Capture ``model.predict_step`` into a CUDA graph at the first call and replay it for the following batches,
+    which removes the launch overhead of the many small kernels in the recurrent rollout. The graph only holds
+    for the shapes it was captured with, a batch of another shape (e.g. the last incomplete one) runs eagerly.
+
+    Note:
+        The returned tensor is a static buffer overwritten by the next replay, copy it before the next call.
+
+    Example:
+        predict_step = GraphedPredictStep(model)
+        for inputs, labels in test_loader:
+            outputs = predict_step(inputs.cuda(), labels.cuda()).cpu()
+    """
+
+    def __init__(self, model: EnhancedModule, warmup: int = 3):
+        self.model = model
+        self.warmup = warmup
+
+        self.graph: Optional[torch.cuda.CUDAGraph] = None
+        self.static_inputs: Optional[Tensor] = None
+        self.static_labels: Optional[Tensor] = None
+        self.static_outputs: Optional[Tensor] = None
+
+    @torch.no_grad()
+    def capture(self, inputs: Tensor, labels: Tensor):
+        self.static_inputs = inputs.clone()
+        self.static_labels = labels.clone()
+
+        # warm up on a side stream so that cuDNN autotuning and lazy initializations are not captured
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(self.warmup):
+                self.model.predict_step(self.static_inputs, self.static_labels)
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_outputs = self.model.predict_step(self.static_inputs, self.static_labels)
+
+    @torch.no_grad()
+    def __call__(self, inputs: Tensor, labels: Tensor) -> Tensor:
+        if self.graph is None:
+            self.capture(inputs, labels)
+
+        if inputs.shape != self.static_inputs.shape or labels.shape != self.static_labels.shape:
+            return self.model.predict_step(inputs, labels)
+
+        self.static_inputs.copy_(inputs, non_blocking=True)
+        self.static_labels.copy_(labels, non_blocking=True)
+        self.graph.replay()
+
+        return self.static_outputs
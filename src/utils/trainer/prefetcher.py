@@ -0,0 +1,73 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @description: copy the next batch to the GPU on a side stream while the current batch is computed
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor
+from torch.utils.data import DataLoader
+
+__all__ = ["DataPrefetcher"]
+
+
+class DataPrefetcher(object):
+    r"""
+    Wrap a DataLoader so that the host to device copy of batch k+1 overlaps the computation of batch k.
+    The copy is only asynchronous when the DataLoader is built with ``pin_memory=True``; on the CPU the
+    batches are passed through unchanged.
+
+    Example:
+        for inputs, labels in DataPrefetcher(train_loader, "cuda:0"):
+            ...
+    """
+
+    def __init__(self, loader: DataLoader, device: str):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+
+        self.next_inputs: Optional[Tensor] = None
+        self.next_labels: Optional[Tensor] = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.prefetch()
+        return self
+
+    def prefetch(self):
+        try:
+            inputs, labels = next(self.iterator)
+        except StopIteration:
+            self.next_inputs = None
+            self.next_labels = None
+            return
+
+        if self.stream is None:
+            self.next_inputs = inputs.to(self.device)
+            self.next_labels = labels.to(self.device)
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_inputs = inputs.to(self.device, non_blocking=True)
+            self.next_labels = labels.to(self.device, non_blocking=True)
+
+    def __next__(self) -> Tuple[Tensor, Tensor]:
+        if self.next_inputs is None:
+            raise StopIteration
+
+        inputs = self.next_inputs
+        labels = self.next_labels
+
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # the tensors are allocated on the side stream, tell the allocator they are used by the main one
+            inputs.record_stream(current_stream)
+            labels.record_stream(current_stream)
+
+        self.prefetch()
+
+        return inputs, labels
@@ -4,18 +4,39 @@
 # @author: 芜情
 # @description: the abstract training or testing process of model
 import sys
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional
 
 import torch
 from torch import Tensor
 from torch.utils.data import DataLoader
 
 from nn import EnhancedModule
+from utils.trainer.cuda_graph import GraphedPredictStep
 from utils.trainer.file_monitor import CheckpointMonitor
 from utils.trainer.module_helpers import is_overridden
+from utils.trainer.prefetcher import DataPrefetcher
 from utils.trainer.progress_bar import progress_bar
 
 
+def detach_to_cpu(obj: Any) -> Any:
+    r"""
+    Recursively copy the tensors in a (nested) state dict to the host, the copies are not affected by the
+    following optimizer steps, so they can be saved in a background thread.
+    """
+    if isinstance(obj, Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copied = type(obj)((key, detach_to_cpu(value)) for key, value in obj.items())
+        # the version information of the modules, used by load_state_dict()
+        if hasattr(obj, "_metadata"):
+            copied._metadata = obj._metadata
+        return copied
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(detach_to_cpu(value) for value in obj)
+    return obj
+
+
 class Trainer(object):
 
     def __init__(
@@ -23,7 +44,12 @@ class Trainer(object):
             max_epoch: int,
             device: str = None,
             to_save: str,
-            seed: int = 2022
+            seed: int = 2022,
+            deterministic: bool = False,
+            use_amp: bool = True,
+            use_compile: bool = False,
+            use_cuda_graph: bool = False,
+            use_script: bool = False
     ):
         self.max_epoch = max_epoch
         self.device = device if device is not None else "cuda:0" if torch.cuda.is_available() else "cpu"
@@ -31,10 +57,58 @@ class Trainer(object):
 
         self.monitor = CheckpointMonitor(src_path=".", dest_path=to_save)
 
+        # the checkpoints are written by a background thread, the next epoch starts without waiting for the disk
+        self.io_pool = ThreadPoolExecutor(max_workers=1)
+        self.pending_save: Optional[Future] = None
+
         # fix the seed in order to keep the idempotence
         torch.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
 
+        if deterministic:
+            torch.backends.cudnn.deterministic = True
+            torch.backends.cudnn.benchmark = False
+        else:
+            # the input shape is fixed during the whole run, let cuDNN pick the fastest convolution once
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+
+        # mixed precision is only available on the GPU, prefer bfloat16 which needs no loss scaling
+        self.use_amp = use_amp and torch.device(self.device).type == "cuda"
+        self.amp_dtype = torch.bfloat16
+        if self.use_amp and not torch.cuda.is_bf16_supported():
+            self.amp_dtype = torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
+
+        self.use_compile = use_compile
+        if use_compile and not hasattr(torch, "compile"):
+            sys.stderr.write("\ntorch.compile needs PyTorch 2.0 or later, the model will run eagerly.\n")
+            self.use_compile = False
+
+        # the reduce-overhead mode of torch.compile already replays the inference with CUDA graphs
+        self.use_cuda_graph = use_cuda_graph and torch.device(self.device).type == "cuda" and not self.use_compile
+
+        # predict() runs a TorchScript version of the model instead of the eager one, torch.compile is then skipped
+        self.use_script = use_script
+
+    def compile(self, model: EnhancedModule, mode: str):
+        r"""
+        Compile the forward of the model with TorchInductor. Only the bound forward of this instance is replaced,
+        so the *_step methods pick it up through self.forward and the keys of the state_dict are unchanged.
+        The shapes are fixed by the dataset, so the graph is specialized with dynamic=False. Note that the
+        compilation happens in the first iteration, which is therefore much slower than the following ones.
+
+        Args:
+            model: the model to compile
+            mode: "default" for training, "reduce-overhead" to replay the inference with CUDA graphs
+        """
+        if not self.use_compile:
+            return
+        # drop the forward compiled by a previous call, e.g. fit() before predict()
+        model.__dict__.pop("forward", None)
+        model.forward = torch.compile(model.forward, mode=mode, dynamic=False)
+
     def fit(
             self,
             model: EnhancedModule,
@@ -45,7 +119,9 @@ class Trainer(object):
         start_epoch = 1
         model.optimizer = model.configure_optimizer()
         model.lr_scheduler = model.configure_lr_scheduler(model.optimizer)
+        model.scaler = self.scaler
         model.to(self.device)
+        self.compile(model, mode="default")
 
         if ckpt_path is not None:
             checkpoint = torch.load(ckpt_path, map_location=self.device)
@@ -54,6 +130,8 @@ class Trainer(object):
             model.optimizer.load_state_dict(checkpoint["optimizer"])
             if "lr_scheduler" in checkpoint and model.lr_scheduler is not None:
                 model.lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+            if "scaler" in checkpoint:
+                self.scaler.load_state_dict(checkpoint["scaler"])
 
         total_per_epoch = len(train_loader)
 
@@ -64,28 +142,31 @@ class Trainer(object):
             # training loop
             model.train()
 
-            for batch_index, (inputs, labels) in enumerate(train_loader):
-                inputs = inputs.to(self.device)
-                labels = labels.to(self.device)
-
+            # the batches are already on the device, copied on a side stream by the prefetcher
+            for batch_index, (inputs, labels) in enumerate(DataPrefetcher(train_loader, self.device)):
                 model.optimizer.zero_grad(set_to_none=True)
 
-                training_outs = model.training_step(inputs, labels)
-                if is_overridden("training_step_end", model):
-                    training_outs = model.training_step_end(training_outs)
+                with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+                    training_outs = model.training_step(inputs, labels)
+                    if is_overridden("training_step_end", model):
+                        training_outs = model.training_step_end(training_outs)
 
+                backward_done = False
                 if isinstance(training_outs, Tensor):
-                    training_outs.backward()
+                    self.scaler.scale(training_outs).backward()
+                    backward_done = True
                 elif isinstance(training_outs, dict):
                     try:
-                        training_outs["loss"].backward()
+                        self.scaler.scale(training_outs["loss"]).backward()
+                        backward_done = True
                     except KeyError:
                         sys.stderr.write("\nif the training outputs is a dictionary, it must has a key named 'loss'.\n")
                 else:
                     raise TypeError(f"\nthe training_outputs [{training_outs}] is unable to backward().\n")
 
-                # update the optimizer
-                model.optimizer_step()
+                # update the optimizer, GradScaler.step fails when no backward recorded its inf checks
+                if backward_done:
+                    model.optimizer_step()
                 # update the learning rate
                 model.lr_scheduler_step()
 
@@ -96,27 +177,31 @@ class Trainer(object):
 
             # validation loop
             model.eval()
-            mean_loss = 0.0
-
-            for index, (inputs, labels) in enumerate(validation_loader):
-                inputs = inputs.to(self.device)
-                labels = labels.to(self.device)
+            # accumulate on the device, synchronize with the host only once per epoch
+            loss_sum = torch.zeros((), device=self.device)
+            loss_count = 0
 
-                validation_outs = model.validation_step(inputs, labels)
-                if is_overridden("validation_step_end", model):
-                    validation_outs = model.validation_step_end(validation_outs)
+            for inputs, labels in DataPrefetcher(validation_loader, self.device):
+                with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+                    validation_outs = model.validation_step(inputs, labels)
+                    if is_overridden("validation_step_end", model):
+                        validation_outs = model.validation_step_end(validation_outs)
 
                 if isinstance(validation_outs, Tensor):
-                    mean_loss = (mean_loss * index + validation_outs.detach().cpu().item()) / (index + 1)
+                    loss_sum += validation_outs.detach()
+                    loss_count += 1
                 elif isinstance(validation_outs, dict):
                     try:
-                        mean_loss = (mean_loss * index + validation_outs["loss"].detach().cpu().item()) / (index + 1)
+                        loss_sum += validation_outs["loss"].detach()
+                        loss_count += 1
                     except KeyError:
                         sys.stderr.write(
                             "\nif the validation outputs is a dictionary, it must has a key named 'loss'.\n")
                 else:
                     raise TypeError(f"\nthe validation_outs [{validation_outs}] is unable to compute the loss.\n")
 
+            mean_loss = (loss_sum / max(loss_count, 1)).item()
+
             sys.stdout.write(
                 f"\r\33[36mEpoch {epoch:06d} {progress_bar(1, 1)} loss={mean_loss:.10f}\33[0m"
             )
@@ -132,14 +217,54 @@ class Trainer(object):
             }
             if model.lr_scheduler is not None:
                 states_dict["lr_scheduler"] = model.lr_scheduler.state_dict()
+            if self.scaler.is_enabled():
+                states_dict["scaler"] = self.scaler.state_dict()
 
-            torch.save(obj=states_dict, f=f"checkpoint_{epoch:06d}_{mean_loss:.10f}_temp.pth")
+            self.save_checkpoint(states_dict, f"checkpoint_{epoch:06d}_{mean_loss:.10f}_temp.pth")
 
+        self.wait_for_saving()
         self.monitor.stop()
 
         # clear the GPU memery
         torch.cuda.empty_cache()
 
+    def script(self, model: EnhancedModule, test_loader: DataLoader) -> torch.jit.ScriptModule:
+        r"""
+        Script the model for inference and save it as model.ts in the folder to_save. The model is scripted rather
+        than traced to keep the recurrent rollout, then frozen with its predict_step preserved, so that the JIT can
+        fuse the elementwise gates of the cells. The profiling executor specializes the graph during the first runs,
+        so it is warmed up twice with the first test batch.
+
+        Args:
+            model: the model in eval mode, its predict_step must be exported by @torch.jit.export
+            test_loader: the first batch is used to warm up the scripted model
+        """
+        scripted = torch.jit.script(model)
+        scripted = torch.jit.freeze(scripted, preserved_attrs=["predict_step"])
+        scripted = torch.jit.optimize_for_inference(scripted)
+        torch.jit.save(scripted, self.to_save + "/model.ts")
+
+        inputs, labels = next(iter(test_loader))
+        inputs = inputs.to(self.device)
+        labels = labels.to(self.device)
+        with torch.no_grad():
+            for _ in range(2):
+                scripted.predict_step(inputs, labels)
+
+        return scripted
+
+    def save_checkpoint(self, states_dict: dict, path: str):
+        # copy to the host synchronously, the tensors on the device are updated in place by the next steps
+        states_dict = detach_to_cpu(states_dict)
+        # at most one checkpoint is in flight, this also raises the error of the previous saving if any
+        self.wait_for_saving()
+        self.pending_save = self.io_pool.submit(torch.save, states_dict, path)
+
+    def wait_for_saving(self):
+        if self.pending_save is not None:
+            self.pending_save.result()
+            self.pending_save = None
+
     def predict(
             self,
             model: EnhancedModule,
@@ -157,22 +282,65 @@ class Trainer(object):
 
         model.eval()
         model.to(self.device)
+        if self.use_script:
+            model = self.script(model, test_loader)
+        else:
+            self.compile(model, mode="reduce-overhead")
+
+        # the rollout has the same shapes for every batch, so it can be captured once and replayed
+        predict_step = GraphedPredictStep(model) if self.use_cuda_graph else model.predict_step
+
+        # the outputs are copied into a pinned host buffer on a side stream, overlapped with the next batch
+        on_cuda = torch.device(self.device).type == "cuda"
+        copy_stream = torch.cuda.Stream(device=self.device) if on_cuda else None
+        copy_done = None
+        # CUDA graphs (also used by the reduce-overhead compilation) write every batch into the same outputs
+        static_outputs = self.use_cuda_graph or (self.use_compile and not self.use_script)
 
         # test loop
-        total_outputs = []
+        prediction: Optional[Tensor] = None
+        batch_start = 0
         total_per_epoch = len(test_loader)
         for batch_index, (inputs, labels) in enumerate(test_loader):
-            inputs = inputs.to(self.device)
-            labels = labels.to(self.device)
+            # asynchronous when the DataLoader uses pinned memory, the copy is ordered before predict_step anyway
+            inputs = inputs.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+
+            if static_outputs and copy_done is not None:
+                # do not overwrite the outputs of the previous batch before they reach the host
+                torch.cuda.current_stream(self.device).wait_event(copy_done)
+
+            outputs = predict_step(inputs, labels).detach()
+            batch_end = batch_start + outputs.shape[0]
 
-            outputs = model.predict_step(inputs, labels)
-            total_outputs.append(outputs.detach().cpu())
+            if prediction is None:
+                prediction = torch.empty(len(test_loader.dataset), *outputs.shape[1:], dtype=outputs.dtype,
+                                         pin_memory=on_cuda)
+
+            if copy_stream is None:
+                prediction[batch_start:batch_end].copy_(outputs)
+            else:
+                copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+                with torch.cuda.stream(copy_stream):
+                    prediction[batch_start:batch_end].copy_(outputs, non_blocking=True)
+                    copy_done = copy_stream.record_event()
+                outputs.record_stream(copy_stream)
+
+            batch_start = batch_end
 
             sys.stdout.write(f"\r\33[94m正在处理 {progress_bar(batch_index + 1, total_per_epoch)}\33[0m")
             sys.stdout.flush()
 
-        prediction = torch.cat(total_outputs, dim=0)
+        if copy_stream is not None:
+            copy_stream.synchronize()
+
+        if prediction is None:
+            raise RuntimeError("\nthe test_loader yields no batch, there is nothing to predict.\n")
 
+        # drop_last or a sampler may skip samples, only the rows written above hold outputs. torch.save writes the
+        # whole storage of a view, so the slice is cloned to keep the unused rows out of the file
+        if batch_start < prediction.shape[0]:
+            prediction = prediction[:batch_start].clone()
         torch.save(prediction, f=self.to_save + "/prediction.pth")
 
         sys.stdout.write(f"\r\33[94m处理完毕 {progress_bar(total_per_epoch, total_per_epoch)}\33[0m")
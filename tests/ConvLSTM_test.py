@@ -7,8 +7,46 @@
 import unittest
 import torch
 
-from src.nn.ConvLSTM import ConvLSTM
+from src.nn.ConvLSTM import ConvLSTM, ConvLSTM_MovingMNIST
+from src.nn.ConvLSTM.ConvLSTM import Encoder
 from src.nn.ConvLSTM.ConvLSTMCell import ConvLSTMCell
+from src.utils.patch import reshape_patch, reshape_patch_back
+
+
+# the original per-cell implementation, used as the reference of the fused and buffered paths
+def reference_cell(cell, x, h, c):
+    i_x, f_x, c_x, o_x = torch.split(cell.conv_x(x), cell.hidden_channels, dim=1)
+    i_h, f_h, c_h, o_h = torch.split(cell.conv_h(h), cell.hidden_channels, dim=1)
+    i = torch.sigmoid(i_x + i_h + cell.w_ci * c)
+    f = torch.sigmoid(f_x + f_h + cell.forget_bias)
+    c = f * c + i * torch.tanh(c_x + c_h)
+    o = torch.sigmoid(o_x + o_h + cell.w_co * c)
+    h = o * torch.tanh(c)
+    return h, c
+
+
+def reference_forward(model, inputs, out_len):
+    encoder, forecast = model.encoder.encoder, model.forecast.forecast
+    batch, sequence, _, height, width = inputs.shape
+    h = [torch.zeros(batch, cell.hidden_channels, height, width) for cell in encoder]
+    c = [torch.zeros(batch, cell.hidden_channels, height, width) for cell in encoder]
+    for s in range(sequence):
+        x = inputs[:, s]
+        for i, cell in enumerate(encoder):
+            h[i], c[i] = reference_cell(cell, x, h[i], c[i])
+            x = h[i]
+    prediction = []
+    for _ in range(out_len):
+        x = torch.zeros(batch, model.forecast.in_channels, height, width)
+        for i, cell in enumerate(forecast):
+            h[i], c[i] = reference_cell(cell, x, h[i], c[i])
+            x = h[i]
+        prediction.append(model.forecast.conv_last(torch.cat(h, dim=1)))
+    return torch.stack(prediction, dim=0).permute(1, 0, 2, 3, 4)
+
+
+def reference_outputs(model, inputs):
+    return reshape_patch_back(reference_forward(model, reshape_patch(inputs, patch_size=4), 10), patch_size=4)
 
 
 class TestConvLSTM(unittest.TestCase):
@@ -31,3 +69,58 @@ class TestConvLSTM(unittest.TestCase):
         results = net(inputs, 10)
         self.assertTrue(results.shape == (7, 10, 1, 100, 100))
         results.sum().backward()
+
+    def test_fused_hidden_conv(self):
+        encoder = Encoder(in_channels=4, hidden_channels_list=[8, 8], size=(16, 16), kernel_size_list=[3, 3])
+        self.assertTrue(encoder.encoder.fuse_hidden_conv)
+        inputs = torch.rand(2, 5, 4, 16, 16)
+        fused_h, fused_c = encoder(inputs)
+        encoder.encoder.fuse_hidden_conv = False
+        h, c = encoder(inputs)
+        for i in range(2):
+            self.assertTrue(torch.allclose(fused_h[i], h[i], atol=1e-6))
+            self.assertTrue(torch.allclose(fused_c[i], c[i], atol=1e-6))
+
+    def test_checkpoint_steps(self):
+        # the checkpointed run goes first, so that it starts from a cold TorchScript profiling executor
+        encoder = Encoder(in_channels=4, hidden_channels_list=[8, 8], size=(16, 16), kernel_size_list=[3, 3],
+                          use_checkpoint=True)
+        inputs = torch.rand(2, 5, 4, 16, 16)
+        encoder(inputs)[0][-1].sum().backward()
+        # w_cf is not used by the cell, so it never gets a gradient
+        params = [p for p in encoder.parameters() if p.grad is not None]
+        grads = [p.grad.clone() for p in params]
+        encoder.zero_grad()
+        encoder.use_checkpoint = False
+        encoder(inputs)[0][-1].sum().backward()
+        for grad, p in zip(grads, params):
+            self.assertTrue(torch.allclose(grad, p.grad, atol=1e-6))
+
+    def test_reference_equivalence(self):
+        # uniform layers take the grouped hidden conv, the others the per-cell one
+        for hidden_channels_list in ([16, 16], [8, 12], [8, 8, 8]):
+            kernel_size_list = [3] * len(hidden_channels_list)
+            model = ConvLSTM_MovingMNIST(in_channels=16, hidden_channels_list=hidden_channels_list, size=(4, 4),
+                                         kernel_size_list=kernel_size_list)
+            # non-zero peephole weights, so that the c terms of the gates are checked as well
+            for p in model.parameters():
+                p.data.uniform_(-0.3, 0.3)
+            inputs = torch.rand(2, 10, 1, 16, 16)
+            labels = torch.rand(2, 10, 1, 16, 16)
+
+            # predict_step without grad uses the preallocated concat buffer and the h_stacked reuse
+            model.eval()
+            with torch.no_grad():
+                outputs = model.predict_step(inputs, labels)
+                expected = reference_outputs(model, inputs).clamp(0, 1)
+            self.assertTrue(torch.allclose(outputs, expected, atol=1e-5))
+
+            # the training path concatenates each step and calls conv_last once
+            model.train()
+            model.training_step(inputs, labels).backward()
+            params = [p for p in model.parameters() if p.grad is not None]
+            grads = [p.grad.clone() for p in params]
+            model.zero_grad()
+            torch.nn.functional.mse_loss(reference_outputs(model, inputs), labels).backward()
+            for grad, p in zip(grads, params):
+                self.assertTrue(torch.allclose(grad, p.grad, atol=1e-4))
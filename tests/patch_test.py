@@ -0,0 +1,34 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @description: test for patch
+import unittest
+
+import torch
+
+from src.utils.patch import reshape_patch, reshape_patch_back
+
+
+def permute_reshape_patch(img_tensor, patch_size):
+    batch, seq, channel, height, width = img_tensor.shape
+    a = img_tensor.permute(0, 1, 3, 4, 2)
+    b = a.reshape(batch, seq, height // patch_size, patch_size, width // patch_size, patch_size, channel)
+    c = b.permute(0, 1, 2, 4, 3, 5, 6)
+    d = c.reshape(batch, seq, height // patch_size, width // patch_size, patch_size * patch_size * channel)
+    return d.permute(0, 1, 4, 2, 3)
+
+
+class TestPatch(unittest.TestCase):
+
+    def test_reshape_patch(self):
+        for channel in (1, 3):
+            img = torch.rand(2, 5, channel, 16, 16)
+            patch = reshape_patch(img, patch_size=4)
+            self.assertTrue(patch.shape == (2, 5, 16 * channel, 4, 4))
+            self.assertTrue(torch.equal(patch, permute_reshape_patch(img, 4)))
+            self.assertTrue(torch.equal(reshape_patch_back(patch, patch_size=4), img))
+
+    def test_reshape_patch_channels_last(self):
+        for channel in (1, 3):
+            patch = reshape_patch(torch.rand(2, 5, channel, 16, 16), patch_size=4)
+            # 每一帧都应是 channels_last，Encoder 的卷积不需要再转换布局
+            self.assertTrue(patch.permute(0, 1, 3, 4, 2).is_contiguous())